@@ -28,6 +28,14 @@
 import sys
 import os
 import time
+import shutil
+import functools
+import heapq
+import bisect
+import collections
+import concurrent.futures
+import selectors
+import threading
 import subprocess
 import logging
 import argparse
@@ -36,98 +44,310 @@ from . import util
 from . import endpoint
 
 
+def splice_with_progress(src, dest_fd):
+    """
+    Moves all data from the pipe ``src`` (a file object) to the pipe
+    ``dest_fd`` using os.splice(), so that it never gets copied to user
+    space. Transferred bytes and rate are printed to stderr, similar to
+    what pv does. Both pipe ends are closed afterwards.
+    """
+
+    total = 0
+    start = last_update = time.monotonic()
+    try:
+        while True:
+            n = os.splice(src.fileno(), dest_fd, util.PIPE_SIZE)
+            if not n:
+                break
+            total += n
+            now = time.monotonic()
+            if now - last_update >= 1:
+                last_update = now
+                print("\r{:>10} {:>10}/s ".format(
+                          util.format_size(total),
+                          util.format_size(total / (now - start))),
+                      end="", file=sys.stderr, flush=True)
+    except OSError as e:
+        # the receiving side has probably gone away; this is reported
+        # via its return code
+        logging.debug("  -> splicing stopped: %s", e)
+    finally:
+        os.close(dest_fd)
+        src.close()
+    duration = max(time.monotonic() - start, 0.001)
+    print("\r{:>10} {:>10}/s ".format(util.format_size(total),
+                                      util.format_size(total / duration)),
+          file=sys.stderr, flush=True)
+
+
+def buffer_stream(src, dest_fd, size):
+    """
+    Copies all data from the pipe ``src`` (a file object) to the pipe
+    ``dest_fd``, holding up to ``size`` bytes in memory, so that the
+    sending side can go on while the receiving side is stalled. This is
+    what mbuffer does. Reading stops as soon as writing fails. Both pipe
+    ends are closed afterwards.
+    """
+
+    chunks = collections.deque()
+    buffered = 0
+    done = failed = False
+    cond = threading.Condition()
+
+    def write():
+        nonlocal buffered, failed
+        try:
+            while True:
+                with cond:
+                    while not chunks and not done:
+                        cond.wait()
+                    if not chunks:
+                        return
+                    chunk = chunks.popleft()
+                    buffered -= len(chunk)
+                    cond.notify_all()
+                view = memoryview(chunk)
+                while view:
+                    view = view[os.write(dest_fd, view):]
+        except OSError as e:
+            # the receiving side has probably gone away; this is reported
+            # via its return code
+            logging.debug("  -> buffering stopped: %s", e)
+            with cond:
+                failed = True
+                chunks.clear()
+                cond.notify_all()
+        finally:
+            os.close(dest_fd)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        while True:
+            chunk = os.read(src.fileno(), util.PIPE_SIZE)
+            if not chunk:
+                break
+            with cond:
+                while buffered >= size and not failed:
+                    cond.wait()
+                if failed:
+                    # closing src below makes the sending side get SIGPIPE
+                    break
+                chunks.append(chunk)
+                buffered += len(chunk)
+                cond.notify_all()
+    finally:
+        with cond:
+            done = True
+            cond.notify_all()
+        writer.join()
+        src.close()
+
+
 def send_snapshot(snapshot, dest_endpoint, parent=None, clones=None,
-                  no_progress=False):
+                  pv_path=None, splice_progress=False, buffer_cmd=None,
+                  buffer_size=None):
     """
     Sends snapshot to destination endpoint, using given parent and clones.
-    It connects the pipes of source and destination together and shows
-    progress data using the pv command.
+    It connects the pipes of source and destination together and, if
+    ``buffer_cmd`` is given, passes the stream through that command to
+    buffer it in between. Otherwise, if ``buffer_size`` is given, up to
+    that many bytes are buffered by ``buffer_stream`` in a thread.
+    If ``pv_path`` is given, progress data is shown using that pv command.
+    Otherwise, if ``splice_progress`` is set, the stream is relayed through
+    ``splice_with_progress`` in a thread.
     """
 
     # Now we need to send the snapshot (incrementally, if possible)
-    logging.info("Sending {} ...".format(snapshot))
+    logging.info("Sending %s ...", snapshot)
     if parent:
-        logging.info("  Using parent: {}".format(parent))
+        logging.info("  Using parent: %s", parent)
     else:
         logging.info("  No parent snapshot available, sending in full mode.")
     if clones:
-        logging.info("  Using clones: {}".format(clones))
-
-    pv = False
-    if not no_progress:
-        # check whether pv is available
-        logging.debug("Checking for pv ...")
-        cmd = ["pv", "--help"]
-        logging.debug("Executing: {}".format(cmd))
-        try:
-            subprocess.call(cmd, stdout=subprocess.DEVNULL,
-                            stderr=subprocess.DEVNULL)
-        except FileNotFoundError as e:
-            logging.debug("  -> got exception: {}".format(e))
-            logging.debug("  -> pv is not available")
-        else:
-            logging.debug("  -> pv is available")
-            pv = True
+        logging.info("  Using clones: %s", clones)
 
+    # Larger pipe buffers let the processes run longer without blocking
+    # each other, which reduces context switches.
     pipes = []
     pipes.append(snapshot.endpoint.send(snapshot, parent=parent, clones=clones))
-
-    if pv:
-        cmd = ["pv"]
-        logging.debug("Executing: {}".format(cmd))
-        pipes.append(subprocess.Popen(cmd, stdin=pipes[-1].stdout,
+    # the pipe the next stage reads from
+    stream = pipes[-1].stdout
+    util.set_pipe_size(stream)
+    threads = []
+
+    if buffer_cmd:
+        # The buffer keeps the sending process busy while the receiving
+        # one is stalled, e.g. on committing a transaction.
+        logging.debug("Executing: %s", buffer_cmd)
+        pipes.append(subprocess.Popen(buffer_cmd, stdin=stream,
                                       stdout=subprocess.PIPE))
+        # Only the reading process may hold the read end, so that the
+        # writing one gets SIGPIPE when the reader dies.
+        stream.close()
+        stream = pipes[-1].stdout
+        util.set_pipe_size(stream)
+    elif buffer_size:
+        read_fd, write_fd = os.pipe()
+        util.set_pipe_size(write_fd)
+        threads.append(threading.Thread(target=buffer_stream,
+                                        args=(stream, write_fd, buffer_size)))
+        stream = os.fdopen(read_fd, "rb")
+
+    if pv_path:
+        cmd = [pv_path]
+        logging.debug("Executing: %s", cmd)
+        pipes.append(subprocess.Popen(cmd, stdin=stream,
+                                      stdout=subprocess.PIPE))
+        stream.close()
+        stream = pipes[-1].stdout
+        util.set_pipe_size(stream)
+
+    if not pv_path and splice_progress:
+        read_fd, write_fd = os.pipe()
+        util.set_pipe_size(write_fd)
+        try:
+            pipes.append(dest_endpoint.receive(read_fd))
+        except:
+            os.close(write_fd)
+            raise
+        finally:
+            # the receiving process holds its own copy
+            os.close(read_fd)
+        threads.append(threading.Thread(target=splice_with_progress,
+                                        args=(stream, write_fd)))
+    else:
+        # Without pv, the receiving process reads directly from the pipe
+        # the previous stage writes to, so the stream doesn't pass through
+        # this process unless buffered by it.
+        pipes.append(dest_endpoint.receive(stream))
+        stream.close()
+
+    for thread in threads:
+        thread.start()
+    try:
+        wait_for_pipes(pipes)
+    finally:
+        for thread in threads:
+            thread.join()
+
+
+def wait_for_pipes(pipes):
+    """
+    Waits for all processes in ``pipes`` to exit. As soon as one of them
+    fails, the remaining ones are terminated and
+    ``util.SnapshotTransferError`` is raised.
+    Where available, pidfds are used to get notified about whichever
+    process exits first; otherwise, the processes are waited for in order.
+    """
 
-    pipes.append(dest_endpoint.receive(pipes[-1].stdout))
+    pidfds = {}
+    try:
+        for pipe in pipes:
+            pidfds[os.pidfd_open(pipe.pid)] = pipe
+    except (AttributeError, OSError) as e:
+        # Python < 3.9 or Linux < 5.3
+        logging.debug("  -> can't use pidfds: %s", e)
+        for pidfd in pidfds:
+            os.close(pidfd)
+        # A failing process makes its neighbours in the pipeline exit as
+        # well, hence waiting for them one by one terminates either way.
+        for pipe in pipes:
+            retcode = pipe.wait()
+            logging.debug("  -> PID %s exited with return code %s",
+                          pipe.pid, retcode)
+            if retcode != 0:
+                abort_pipes(pipes)
+        return
 
-    pids = [pipe.pid for pipe in pipes]
-    while pids:
-        pid, retcode = os.wait()
-        if pid in pids:
-            logging.debug("  -> PID {} exited with return code "
-                          "{}".format(pid, retcode))
-            pids.remove(pid)
-        if retcode != 0:
-            logging.error("Error during btrfs send / receive")
-            raise util.SnapshotTransferError()
+    try:
+        with selectors.DefaultSelector() as selector:
+            for pidfd in pidfds:
+                selector.register(pidfd, selectors.EVENT_READ)
+            while pidfds:
+                for key, events in selector.select():
+                    selector.unregister(key.fd)
+                    os.close(key.fd)
+                    pipe = pidfds.pop(key.fd)
+                    # the process has exited already, so this won't block
+                    retcode = pipe.wait()
+                    logging.debug("  -> PID %s exited with return code %s",
+                                  pipe.pid, retcode)
+                    if retcode != 0:
+                        abort_pipes(pipes)
+    finally:
+        for pidfd in pidfds:
+            os.close(pidfd)
+
+
+def abort_pipes(pipes):
+    """
+    Terminates all processes in ``pipes`` that are still running, waits
+    for them and raises ``util.SnapshotTransferError``.
+    """
+
+    logging.error("Error during btrfs send / receive")
+    for pipe in pipes:
+        if pipe.poll() is None:
+            logging.debug("  -> terminating PID %s", pipe.pid)
+            pipe.terminate()
+    for pipe in pipes:
+        pipe.wait()
+    raise util.SnapshotTransferError()
 
 
 def sync_snapshots(src_endpoint, dest_endpoint, keep_num_backups=0,
-                   no_incremental=False, **kwargs):
+                   no_incremental=False, src_snapshots=None, **kwargs):
     """
     Synchronizes snapshots from source to destination. Takes care
     about locking and deletion of corrupt snapshots from failed transfers.
     It never transfers snapshots that would anyway be deleted afterwards
     due to retention policy.
+    If ``src_snapshots`` is given, it is used instead of listing the
+    source endpoint's snapshots again; it is not modified.
     """
 
     logging.info(util.log_heading("  To {} ...".format(dest_endpoint)))
 
-    src_snapshots = src_endpoint.list_snapshots()
+    if src_snapshots is None:
+        src_snapshots = src_endpoint.list_snapshots()
+    if not src_snapshots:
+        # no need to look at the destination at all
+        logging.info("No snapshots need to be transferred.")
+        return
     dest_snapshots = dest_endpoint.list_snapshots()
     dest_id = dest_endpoint.get_id()
 
+    # bind frequently used callables to locals for the loops below
+    set_lock = src_endpoint.set_lock
+    add_snapshot = dest_endpoint.add_snapshot
+    SnapshotTransferError = util.SnapshotTransferError
+    src_index = {s: i for i, s in enumerate(src_snapshots)}.__getitem__
+
     # delete corrupt snapshots from destination
     to_remove = []
-    for snapshot in src_snapshots:
-        if snapshot in dest_snapshots and dest_id in snapshot.locks:
+    locked = {s for s in src_snapshots if dest_id in s.locks}
+    for dest_snapshot in dest_snapshots:
+        if dest_snapshot in locked:
             # seems to have failed previously and is present at
             # destination; delete corrupt snapshot there
-            dest_snapshot = dest_snapshots[dest_snapshots.index(snapshot)]
-            logging.info("Potentially corrupt snapshot {} found at "
-                         "{}".format(dest_snapshot, dest_endpoint))
+            logging.info("Potentially corrupt snapshot %s found at %s",
+                         dest_snapshot, dest_endpoint)
             to_remove.append(dest_snapshot)
     if to_remove:
         dest_endpoint.delete_snapshots(to_remove)
         # refresh list of snapshots at destination to have deleted ones
         # disappear
         dest_snapshots = dest_endpoint.list_snapshots()
+    # only membership is tested from now on
+    dest_snapshots = set(dest_snapshots)
     # now that deletion worked, remove all locks for this destination
-    for snapshot in src_snapshots:
-        if dest_id in snapshot.locks:
-            src_endpoint.set_lock(snapshot, dest_id, False)
-        if dest_id in snapshot.parent_locks:
-            src_endpoint.set_lock(snapshot, dest_id, False, parent=True)
+    to_unlock = [s for s in src_snapshots if dest_id in s.locks]
+    if to_unlock:
+        src_endpoint.set_locks(to_unlock, dest_id, False)
+    to_unlock = [s for s in src_snapshots if dest_id in s.parent_locks]
+    if to_unlock:
+        src_endpoint.set_locks(to_unlock, dest_id, False, parent=True)
 
     logging.debug("Planning transmissions ...")
     to_consider = src_snapshots
@@ -141,59 +361,98 @@ def sync_snapshots(src_endpoint, dest_endpoint, keep_num_backups=0,
         logging.info("No snapshots need to be transferred.")
         return
 
-    logging.info("Going to transfer {} snapshot(s):".format(len(to_transfer)))
-    for snapshot in to_transfer:
-        logging.info("  {}".format(snapshot))
-
-    while to_transfer:
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info("Going to transfer %s snapshot(s):", len(to_transfer))
+        for snapshot in to_transfer:
+            logging.info("  %s", snapshot)
+
+    # pick the snapshots common among source and dest, exclude those
+    # that had a failed transfer before; kept sorted and up to date below
+    present_snapshots = [s for s in src_snapshots
+                         if s in dest_snapshots and dest_id not in s.locks]
+    # parents found for the current present_snapshots; they only change
+    # after a successful transfer
+    rescore = True
+    parent_cache = {}
+    def get_parent(s):
+        if s not in parent_cache:
+            parent_cache[s] = s.find_parent(present_snapshots)
+        return parent_cache[s]
+    # choose snapshot with smallest distance to its parent
+    def key(s):
+        p = get_parent(s)
+        if p is None:
+            return 999999999
+        d = src_index(s) - src_index(p)
+        return -d if d < 0 else d
+
+    # priority queue of (key, position, snapshot); without incremental
+    # sending, simply the latest snapshot is chosen first
+    queue = [(-i, i, s) for i, s in enumerate(to_transfer)]
+    heapq.heapify(queue)
+
+    while queue:
         if no_incremental:
-            # simply choose the last one
-            best_snapshot = to_transfer[-1]
+            best_snapshot = heapq.heappop(queue)[2]
             parent = None
             clones = []
         else:
-            # pick the snapshots common among source and dest,
-            # exclude those that had a failed transfer before
-            present_snapshots = [s for s in src_snapshots
-                                 if s in dest_snapshots and
-                                    dest_id not in s.locks]
-            # choose snapshot with smallest distance to its parent
-            def key(s):
-                p = s.find_parent(present_snapshots)
-                if p is None:
-                    return 999999999
-                d = src_snapshots.index(s) - src_snapshots.index(p)
-                return -d if d < 0 else d
-            best_snapshot = min(to_transfer, key=key)
-            parent = best_snapshot.find_parent(present_snapshots)
+            if rescore:
+                rescore = False
+                parent_cache.clear()
+                # re-score the remaining snapshots
+                queue = [(key(s), i, s) for _, i, s in queue]
+                heapq.heapify(queue)
+            best_snapshot = heapq.heappop(queue)[2]
+            parent = get_parent(best_snapshot)
             # we don't use clones at the moment, because they don't seem
             # to speed things up
             #clones = present_snapshots
             clones = []
-        src_endpoint.set_lock(best_snapshot, dest_id, True)
+        set_lock(best_snapshot, dest_id, True)
         if parent:
-            src_endpoint.set_lock(parent, dest_id, True, parent=True)
+            set_lock(parent, dest_id, True, parent=True)
         try:
             send_snapshot(best_snapshot, dest_endpoint, parent=parent,
                           clones=clones, **kwargs)
-        except util.SnapshotTransferError:
-            logging.info("Keeping {} locked to prevent it from getting "
-                         "removed.".format(best_snapshot))
+        except SnapshotTransferError:
+            logging.info("Keeping %s locked to prevent it from getting "
+                         "removed.", best_snapshot)
         else:
-            src_endpoint.set_lock(best_snapshot, dest_id, False)
+            set_lock(best_snapshot, dest_id, False)
             if parent:
-                src_endpoint.set_lock(parent, dest_id, False, parent=True)
-            dest_endpoint.add_snapshot(best_snapshot)
-            dest_snapshots = dest_endpoint.list_snapshots()
-        to_transfer.remove(best_snapshot)
+                set_lock(parent, dest_id, False, parent=True)
+            add_snapshot(best_snapshot)
+            dest_snapshots.add(best_snapshot)
+            # its lock has been released, so it is present now
+            bisect.insort(present_snapshots, best_snapshot)
+            rescore = True
 
     logging.info(util.log_heading("Transfers to {} "
                                   "complete!".format(dest_endpoint)))
 
 
-def run(argv):
-    """Run the program. Items in ``argv`` are treated as command line
-       arguments."""
+def for_each_endpoint(func, endpoints, parallel=False):
+    """
+    Calls ``func`` with each of the given ``endpoints``. If ``parallel``
+    is set, the calls are made concurrently in separate threads.
+    Exceptions raised by ``func`` are passed on.
+    """
+
+    if parallel and len(endpoints) > 1:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(endpoints)) as executor:
+            # consume the results to re-raise exceptions
+            list(executor.map(func, endpoints))
+    else:
+        for e in endpoints:
+            func(e)
+
+
+@functools.lru_cache(maxsize=1)
+def build_parser():
+    """Builds the command line argument parser. The result is cached,
+       so the parser is only built once per process."""
 
     description = """\
 This provides incremental backups for btrfs filesystems. It can be
@@ -216,7 +475,7 @@ a file from another one. When doing so, make sure to not create infinite
 loops by including files mutually. Mixing of direct arguments and argument
 files is allowed as well."""
 
-    # Parse command line arguments
+    # Build the command line parser
     parser = util.MyArgumentParser(description=description, epilog=epilog,
                                    add_help=False, fromfile_prefix_chars="@",
                                    formatter_class=util.MyHelpFormatter)
@@ -267,6 +526,20 @@ files is allowed as well."""
                        help="Don't ever try to send snapshots incrementally. "
                             "This might be useful when piping to a file for "
                             "storage.")
+    group.add_argument("--parallel", action="store_true",
+                       help="Prepare, transfer to and clean up all "
+                            "destinations concurrently instead of one after "
+                            "another. Progress is not displayed in this mode. "
+                            "Don't use this if ssh needs to ask for "
+                            "passwords.")
+    group.add_argument("--buffer-size", metavar="SIZE", type=util.parse_size,
+                       help="Buffer up to SIZE bytes of the stream in "
+                            "memory between sending and receiving, so that "
+                            "btrfs send doesn't have to wait while btrfs "
+                            "receive is busy. The suffixes k, M, G and T "
+                            "(multiples of 1024) may be used, e.g. '512M'. "
+                            "mbuffer(1) is used if installed, otherwise the "
+                            "stream is buffered by btrfs-backup itself.")
 
     group = parser.add_argument_group("SSH related options")
     group.add_argument("--ssh-opt", action="append", default=[],
@@ -336,12 +609,23 @@ files is allowed as well."""
                             "for instance, for well-organized local "
                             "snapshotting without backing up.")
 
+    return parser
+
+
+def run(argv):
+    """Run the program. Items in ``argv`` are treated as command line
+       arguments."""
+
+    parser = build_parser()
     try:
         args = parser.parse_args(argv)
     except RecursionError as e:
         print("Recursion error while parsing arguments.\n"
               "Maybe you produced a loop in argument files?", file=sys.stderr)
         raise util.AbortError()
+    # the default list is owned by the cached parser and mustn't be
+    # modified when adding locked destinations
+    args.dest = list(args.dest)
 
     # applying shortcuts
     if args.quiet:
@@ -349,6 +633,12 @@ files is allowed as well."""
         args.verbosity = "warning"
     if args.latest_only:
         args.num_snapshots = 1
+    if args.parallel:
+        # output of multiple pv processes would be mixed up
+        args.no_progress = True
+    # destination endpoints are only needed for transferring or for
+    # applying the retention policy of backups
+    need_dests = not args.no_transfer or args.num_backups > 0
 
     logging.basicConfig(format="%(asctime)s  [%(levelname)-5s]  %(message)s",
                         datefmt="%H:%M:%S",
@@ -367,27 +657,26 @@ files is allowed as well."""
     else:
         snapprefix = ""
 
-    logging.debug("Enable btrfs debugging: {}".format(args.btrfs_debug))
-    logging.debug("Don't display progress: {}".format(args.no_progress))
-    logging.debug("Don't take a new snapshot: {}".format(args.no_snapshot))
-    logging.debug("Number of snapshots to keep: {}".format(args.num_snapshots))
-    logging.debug("Number of backups to keep: "
-                  "{}".format(args.num_backups if args.num_backups > 0
-                              else "Any"))
-    logging.debug("Snapshot folder: {}".format(snapdir))
-    logging.debug("Snapshot prefix: "
-                  "{}".format(snapprefix if snapprefix else None))
-    logging.debug("Don't transfer snapshots: {}".format(args.no_transfer))
-    logging.debug("Don't send incrementally: {}".format(args.no_incremental))
-    logging.debug("Extra SSH config options: {}".format(args.ssh_opt))
-    logging.debug("Use sudo at SSH remote host: {}".format(args.ssh_sudo))
-    logging.debug("Run 'btrfs subvolume sync' afterwards: {}".format(args.sync))
-    logging.debug("Convert subvolumes to read-write before deletion: "
-                  "{}".format(args.convert_rw))
-    logging.debug("Remove locks for given destinations: "
-                  "{}".format(args.remove_locks))
-    logging.debug("Skip filesystem checks: {}".format(args.skip_fs_checks))
-    logging.debug("Auto add locked destinations: {}".format(args.locked_dests))
+    logging.debug("Enable btrfs debugging: %s", args.btrfs_debug)
+    logging.debug("Don't display progress: %s", args.no_progress)
+    logging.debug("Don't take a new snapshot: %s", args.no_snapshot)
+    logging.debug("Number of snapshots to keep: %s", args.num_snapshots)
+    logging.debug("Number of backups to keep: %s",
+                  args.num_backups if args.num_backups > 0 else "Any")
+    logging.debug("Snapshot folder: %s", snapdir)
+    logging.debug("Snapshot prefix: %s", snapprefix if snapprefix else None)
+    logging.debug("Don't transfer snapshots: %s", args.no_transfer)
+    logging.debug("Don't send incrementally: %s", args.no_incremental)
+    logging.debug("Transfer to destinations in parallel: %s", args.parallel)
+    logging.debug("Stream buffer size: %s", args.buffer_size)
+    logging.debug("Extra SSH config options: %s", args.ssh_opt)
+    logging.debug("Use sudo at SSH remote host: %s", args.ssh_sudo)
+    logging.debug("Run 'btrfs subvolume sync' afterwards: %s", args.sync)
+    logging.debug("Convert subvolumes to read-write before deletion: %s",
+                  args.convert_rw)
+    logging.debug("Remove locks for given destinations: %s", args.remove_locks)
+    logging.debug("Skip filesystem checks: %s", args.skip_fs_checks)
+    logging.debug("Auto add locked destinations: %s", args.locked_dests)
 
     # kwargs that are common between all endpoints
     endpoint_kwargs = {"snapprefix": snapprefix,
@@ -398,7 +687,7 @@ files is allowed as well."""
                        "ssh_opts": args.ssh_opt,
                        "ssh_sudo": args.ssh_sudo}
 
-    logging.debug("Source: {}".format(args.source))
+    logging.debug("Source: %s", args.source)
     src_endpoint_kwargs = dict(endpoint_kwargs)
     src_endpoint_kwargs["path"] = snapdir
     try:
@@ -406,9 +695,9 @@ files is allowed as well."""
                                                 src_endpoint_kwargs,
                                                 source=True)
     except ValueError as e:
-        logging.error("Couldn't parse source specification: {}".format(e))
+        logging.error("Couldn't parse source specification: %s", e)
         raise util.AbortError()
-    logging.debug("Source endpoint: {}".format(src_endpoint))
+    logging.debug("Source endpoint: %s", src_endpoint)
     src_endpoint.prepare()
 
     # add endpoint creation strings for locked destinations, if desired
@@ -420,33 +709,38 @@ files is allowed as well."""
 
     if args.remove_locks:
         logging.info("Removing locks (--remove-locks) ...")
-        for snapshot in src_endpoint.list_snapshots():
-            for dest in args.dest:
-                if dest in snapshot.locks:
-                    logging.info("  {} ({})".format(snapshot, dest))
-                    src_endpoint.set_lock(snapshot, dest, False)
-                if dest in snapshot.parent_locks:
-                    logging.info("  {} ({}) [parent]".format(snapshot, dest))
-                    src_endpoint.set_lock(snapshot, dest, False, parent=True)
+        src_snapshots = src_endpoint.list_snapshots()
+        for dest in args.dest:
+            to_unlock = [s for s in src_snapshots if dest in s.locks]
+            for snapshot in to_unlock:
+                logging.info("  %s (%s)", snapshot, dest)
+            if to_unlock:
+                src_endpoint.set_locks(to_unlock, dest, False)
+            to_unlock = [s for s in src_snapshots if dest in s.parent_locks]
+            for snapshot in to_unlock:
+                logging.info("  %s (%s) [parent]", snapshot, dest)
+            if to_unlock:
+                src_endpoint.set_locks(to_unlock, dest, False, parent=True)
 
     dest_endpoints = []
     # only create destination endpoints if they are needed
-    if args.no_transfer and args.num_backups <= 0:
+    if not need_dests:
         logging.debug("Don't creating destination endpoints because they "
                       "won't be needed (--no-transfer and no --num-backups).")
     else:
         for dest in args.dest:
-            logging.debug("Destination: {}".format(dest))
+            logging.debug("Destination: %s", dest)
             try:
                 dest_endpoint = endpoint.choose_endpoint(dest, endpoint_kwargs,
                                                          source=False)
             except ValueError as e:
-                logging.error("Couldn't parse destination specification: "
-                              "{}".format(e))
+                logging.error("Couldn't parse destination specification: %s",
+                              e)
                 raise util.AbortError()
             dest_endpoints.append(dest_endpoint)
-            logging.debug("Destination endpoint: {}".format(dest_endpoint))
-            dest_endpoint.prepare()
+            logging.debug("Destination endpoint: %s", dest_endpoint)
+        for_each_endpoint(lambda e: e.prepare(), dest_endpoints,
+                          parallel=args.parallel)
 
     if args.no_snapshot:
         logging.info("Taking no snapshot (--no-snapshot).")
@@ -459,35 +753,81 @@ files is allowed as well."""
         logging.info(util.log_heading("Not transferring (--no-transfer)."))
     else:
         logging.info(util.log_heading("Transferring ..."))
-        for dest_endpoint in dest_endpoints:
+        pv_path = None
+        splice_progress = False
+        if not args.no_progress:
+            # check whether pv is available
+            logging.debug("Checking for pv ...")
+            pv_path = shutil.which("pv")
+            if pv_path is None:
+                logging.debug("  -> pv is not available")
+                # os.splice() is available from Python 3.10 onwards; like
+                # pv, the progress is only shown on a terminal
+                splice_progress = hasattr(os, "splice") and \
+                                  sys.stderr.isatty()
+                if splice_progress:
+                    logging.debug("  -> using built-in progress display")
+            else:
+                logging.debug("  -> pv is available: %s", pv_path)
+        buffer_cmd = None
+        buffer_size = None
+        if args.buffer_size:
+            logging.debug("Checking for mbuffer ...")
+            mbuffer_path = shutil.which("mbuffer")
+            if mbuffer_path is None:
+                logging.debug("  -> mbuffer is not available, buffering "
+                              "in-process")
+                buffer_size = args.buffer_size
+            else:
+                logging.debug("  -> mbuffer is available: %s", mbuffer_path)
+                buffer_cmd = [mbuffer_path, "-q", "-m",
+                              str(args.buffer_size)]
+        # List once for all destinations. This also lets parallel
+        # transfers share the same snapshot objects and locks.
+        src_snapshots = src_endpoint.list_snapshots()
+        def transfer(dest_endpoint):
             try:
                 sync_snapshots(src_endpoint, dest_endpoint,
                                keep_num_backups=args.num_backups,
                                no_incremental=args.no_incremental,
-                               no_progress=args.no_progress)
+                               src_snapshots=src_snapshots,
+                               pv_path=pv_path,
+                               splice_progress=splice_progress,
+                               buffer_cmd=buffer_cmd,
+                               buffer_size=buffer_size)
             except util.AbortError as e:
-                logging.error("Aborting snapshot transfer to {} due to "
-                              " exception.".format(dest_endpoint))
-                logging.debug("Exception was: {}".format(e))
+                logging.error("Aborting snapshot transfer to %s due to "
+                              " exception.", dest_endpoint)
+                logging.debug("Exception was: %s", e)
+        for_each_endpoint(transfer, dest_endpoints, parallel=args.parallel)
         if not dest_endpoints:
             logging.info("No destination configured, don't sending anything.")
 
     logging.info(util.log_heading("Cleaning up ..."))
-    # cleanup snapshots > num_snapshots in snapdir
+    # cleanup snapshots > num_snapshots in snapdir and backups > num_backups
+    # in backup targets; with --parallel, the source is cleaned up together
+    # with the destinations, so that waiting for 'btrfs subvolume sync' at
+    # one endpoint overlaps with the deletions at the others
+    to_clean = []
+    keep_nums = {}
     if args.num_snapshots > 0:
-        try:
-            src_endpoint.delete_old_snapshots(args.num_snapshots)
-        except util.AbortError as e:
-            logging.debug("Got AbortError while deleting source snapshots at "
-                          "{}".format(src_endpoint))
-    # cleanup backups > num_backups in backup target
+        to_clean.append(src_endpoint)
+        keep_nums[src_endpoint] = args.num_snapshots
     if args.num_backups > 0:
+        to_clean.extend(dest_endpoints)
         for dest_endpoint in dest_endpoints:
-            try:
-                dest_endpoint.delete_old_snapshots(args.num_backups)
-            except util.AbortError as e:
-                logging.debug("Got AbortError while deleting backups at "
-                              "{}".format(dest_endpoint))
+            keep_nums[dest_endpoint] = args.num_backups
+    def cleanup(e):
+        try:
+            e.delete_old_snapshots(keep_nums[e])
+        except util.AbortError:
+            if e is src_endpoint:
+                logging.debug("Got AbortError while deleting source "
+                              "snapshots at %s", e)
+            else:
+                logging.debug("Got AbortError while deleting backups at %s",
+                              e)
+    for_each_endpoint(cleanup, to_clean, parallel=args.parallel)
 
     logging.info(util.log_heading("Finished at {}".format(time.ctime())))
 
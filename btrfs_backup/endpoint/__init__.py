@@ -6,6 +6,46 @@ from .ssh import SSHEndpoint
 from .shell import ShellEndpoint
 
 
+def _parse_shell(spec, kwargs, source):
+    kwargs["cmd"] = spec[8:]
+    kwargs["source"] = True
+
+def _parse_ssh(spec, kwargs, source):
+    parsed = urllib.parse.urlparse(spec)
+    if not parsed.hostname:
+        raise ValueError("No hostname for SSh specified.")
+    try:
+        kwargs["port"] = parsed.port
+    except ValueError:
+        # invalid literal for int ...
+        kwargs["port"] = None
+    path = parsed.path.strip() or "/"
+    # This is no URL, so an eventual query part must be appended to path
+    if parsed.query:
+        path += "?" + parsed.query
+    path = os.path.normpath(path)
+    if source:
+        kwargs["source"] = path
+    else:
+        kwargs["path"] = path
+    kwargs["username"] = parsed.username
+    kwargs["hostname"] = parsed.hostname
+
+def _parse_local(spec, kwargs, source):
+    if source:
+        kwargs["source"] = spec
+    else:
+        kwargs["path"] = spec
+
+
+# maps URL schemes to the endpoint class and the function filling its
+# keyword arguments; specifications without known scheme are local paths
+SCHEMES = {
+    "shell": (ShellEndpoint, _parse_shell),
+    "ssh": (SSHEndpoint, _parse_ssh),
+}
+
+
 def choose_endpoint(spec, common_kwargs=None, source=False,
                     excluded_types=()):
     """Chooses a suitable endpoint based on the specification given.
@@ -27,39 +67,13 @@ def choose_endpoint(spec, common_kwargs=None, source=False,
         kwargs.update(common_kwargs)
 
     # parse destination string
-    if ShellEndpoint not in excluded_types and spec.startswith("shell://"):
-        c = ShellEndpoint
-        kwargs["cmd"] = spec[8:]
-        kwargs["source"] = True
-    elif SSHEndpoint not in excluded_types and spec.startswith("ssh://"):
-        c = SSHEndpoint
-        parsed = urllib.parse.urlparse(spec)
-        if not parsed.hostname:
-            raise ValueError("No hostname for SSh specified.")
-        try:
-            kwargs["port"] = parsed.port
-        except ValueError:
-            # invalid literal for int ...
-            kwargs["port"] = None
-        path = parsed.path.strip() or "/"
-        # This is no URL, so an eventual query part must be appended to path
-        if parsed.query:
-            path += "?" + parsed.query
-        path = os.path.normpath(path)
-        if source:
-            kwargs["source"] = path
-        else:
-            kwargs["path"] = path
-        kwargs["username"] = parsed.username
-        kwargs["hostname"] = parsed.hostname
-    elif LocalEndpoint not in excluded_types:
-        c = LocalEndpoint
-        if source:
-            kwargs["source"] = spec
-        else:
-            kwargs["path"] = spec
-    else:
-        raise ValueError("No endpoint could be generated for this "
-                         "specification: {}".format(spec))
+    scheme, sep, rest = spec.partition("://")
+    c, parse = SCHEMES.get(scheme, (None, None)) if sep else (None, None)
+    if c is None or c in excluded_types:
+        c, parse = LocalEndpoint, _parse_local
+        if c in excluded_types:
+            raise ValueError("No endpoint could be generated for this "
+                             "specification: {}".format(spec))
+    parse(spec, kwargs, source)
 
     return c(**kwargs)
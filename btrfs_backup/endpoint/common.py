@@ -1,6 +1,10 @@
+import bisect
 import os
+import re
+import stat
 import subprocess
 import logging
+import threading
 
 from .. import util
 
@@ -31,9 +35,15 @@ class Endpoint:
         self.fs_checks = fs_checks
         self.lock_file_name = ".outstanding_transfers"
         self.__cached_snapshots = None
+        # immutable copy of the cache handed out by list_snapshots
+        self.__snapshots_view = None
+        # (file state, lock dict) of the lock file last read or written
+        self.__cached_locks = None
+        # serializes lock changes of concurrent transfers
+        self.__lock_file_mutex = threading.Lock()
 
     def prepare(self):
-        logging.info("Preparing endpoint {} ...".format(self))
+        logging.info("Preparing endpoint %s ...", self)
         return self._prepare()
 
     @require_source
@@ -42,7 +52,7 @@ class Endpoint:
 
         snapshot = util.Snapshot(self.path, self.snapprefix, self)
         snapshot_path = snapshot.get_path()
-        logging.info("{} -> {}".format(self.source, snapshot_path))
+        logging.info("%s -> %s", self.source, snapshot_path)
 
         cmds = []
         cmds.append(self._build_snapshot_cmd(self.source, snapshot_path,
@@ -53,7 +63,8 @@ class Endpoint:
             cmds.append(self._build_sync_cmd())
 
         for cmd in self._collapse_cmds(cmds, abort_on_failure=True):
-            self._exec_cmd(cmd)
+            self._exec_cmd(cmd, method="check_call",
+                           stdout=subprocess.DEVNULL)
 
         self.add_snapshot(snapshot)
         return snapshot
@@ -77,75 +88,95 @@ class Endpoint:
         return self._exec_cmd(cmd, method="Popen", stdin=stdin, stdout=stdout)
 
     def list_snapshots(self, flush_cache=False):
-        """Returns a list with all snapshots found at ``self.path``.
+        """Returns a tuple with all snapshots found at ``self.path``.
            If ``flush_cache`` is not set, cached results will be used
            if available."""
 
         if self.__cached_snapshots is not None and not flush_cache:
-            logging.debug("Returning {} cached snapshots for "
-                          "{}.".format(len(self.__cached_snapshots), self))
-            return list(self.__cached_snapshots)
+            logging.debug("Returning %s cached snapshots for %s.",
+                          len(self.__cached_snapshots), self)
+            if self.__snapshots_view is None:
+                self.__snapshots_view = tuple(self.__cached_snapshots)
+            return self.__snapshots_view
 
-        logging.debug("Building snapshot cache of {} ...".format(self))
+        logging.debug("Building snapshot cache of %s ...", self)
         snapshots = []
-        listdir = self._listdir(self.path)
-        for item in listdir:
-            if item.startswith(self.snapprefix):
-                time_str = item[len(self.snapprefix):]
-                try:
-                    time_obj = util.str2date(time_str)
-                except ValueError:
-                    # no valid name for current prefix + time string
-                    continue
-                else:
-                    snapshot = util.Snapshot(self.path, self.snapprefix, self,
-                                             time_obj=time_obj)
-                    snapshots.append(snapshot)
-
-        # apply locks
-        if self.source:
-            lock_dict = self._read_locks()
-            for snapshot in snapshots:
+        # locks are applied while listing
+        lock_dict = self._read_locks() if self.source else {}
+        # this loop runs once per item, so avoid repeated lookups
+        path = self.path
+        prefix = self.snapprefix
+        # rejecting other items by a regular expression is much cheaper
+        # than letting str2date fail
+        match_name = re.compile(re.escape(prefix) +
+                                "(" + util.DATE_REGEX + r")\Z").match
+        str2date = util.str2date
+        Snapshot = util.Snapshot
+        for item in self._listdir(path, prefix=prefix):
+            match = match_name(item)
+            if match is None:
+                continue
+            try:
+                time_obj = str2date(match.group(1))
+            except ValueError:
+                # digits not forming a valid date
+                continue
+            snapshot = Snapshot(path, prefix, self, time_obj=time_obj)
+            if lock_dict:
                 snap_entry = lock_dict.get(snapshot.get_name(), {})
                 for lock_type, locks in snap_entry.items():
                     getattr(snapshot, lock_type).update(locks)
+            snapshots.append(snapshot)
 
         # sort by date, then time;
         snapshots.sort()
 
         # populate cache
         self.__cached_snapshots = snapshots
-        logging.debug("Populated snapshot cache of {} with {} "
-                      "items.".format(self, len(snapshots)))
+        self.__snapshots_view = tuple(snapshots)
+        logging.debug("Populated snapshot cache of %s with %s items.",
+                      self, len(snapshots))
 
-        return list(snapshots)
+        return self.__snapshots_view
 
     @require_source
     def set_lock(self, snapshot, lock_id, lock_state, parent=False):
         """Adds/removes the given lock from ``snapshot`` and calls
            ``_write_locks`` with the updated locks."""
-        if lock_state:
-            if parent:
-                snapshot.parent_locks.add(lock_id)
-            else:
-                snapshot.locks.add(lock_id)
-        else:
-            if parent:
-                snapshot.parent_locks.discard(lock_id)
-            else:
-                snapshot.locks.discard(lock_id)
-        lock_dict = {}
-        for _snapshot in self.list_snapshots():
-            snap_entry = {}
-            if _snapshot.locks:
-                snap_entry["locks"] = list(_snapshot.locks)
-            if _snapshot.parent_locks:
-                snap_entry["parent_locks"] = list(_snapshot.parent_locks)
-            if snap_entry:
-                lock_dict[_snapshot.get_name()] = snap_entry
-        self._write_locks(lock_dict)
-        logging.debug("Lock state for {} and lock_id {} changed to {} (parent "
-                      "= {})".format(snapshot, lock_id, lock_state, parent))
+        self.set_locks([snapshot], lock_id, lock_state, parent=parent)
+
+    @require_source
+    def set_locks(self, snapshots, lock_id, lock_state, parent=False):
+        """Like ``set_lock``, but for all given ``snapshots`` at once.
+           ``_write_locks`` is called only once."""
+        with self.__lock_file_mutex:
+            for snapshot in snapshots:
+                if lock_state:
+                    if parent:
+                        snapshot.parent_locks.add(lock_id)
+                    else:
+                        snapshot.locks.add(lock_id)
+                else:
+                    if parent:
+                        snapshot.parent_locks.discard(lock_id)
+                    else:
+                        snapshot.locks.discard(lock_id)
+            if self.__cached_snapshots is None:
+                self.list_snapshots()
+            lock_dict = {}
+            for _snapshot in self.__cached_snapshots:
+                snap_entry = {}
+                if _snapshot.locks:
+                    snap_entry["locks"] = sorted(_snapshot.locks)
+                if _snapshot.parent_locks:
+                    snap_entry["parent_locks"] = sorted(_snapshot.parent_locks)
+                if snap_entry:
+                    lock_dict[_snapshot.get_name()] = snap_entry
+            self._write_locks(lock_dict)
+        for snapshot in snapshots:
+            logging.debug("Lock state for %s and lock_id %s changed to %s "
+                          "(parent = %s)", snapshot, lock_id, lock_state,
+                          parent)
 
     def add_snapshot(self, snapshot, rewrite=True):
         """Adds a snapshot to the cache. If ``rewrite`` is set, a new
@@ -161,40 +192,40 @@ class Endpoint:
             snapshot = util.Snapshot(self.path, snapshot.prefix, self,
                                      time_obj=snapshot.time_obj)
 
-        self.__cached_snapshots.append(snapshot)
-        self.__cached_snapshots.sort()
+        # the cache is sorted already
+        bisect.insort(self.__cached_snapshots, snapshot)
+        self.__snapshots_view = None
 
     def delete_snapshots(self, snapshots, **kwargs):
         """Deletes the given snapshots, passing all keyword arguments to
            ``_build_deletion_cmds``."""
 
-        # only remove snapshots that have no lock remaining
+        # only remove snapshots that have no lock remaining; the decision
+        # is remembered for logging
         to_remove = []
+        decisions = []
         for snapshot in snapshots:
-            if not snapshot.locks and not snapshot.parent_locks:
+            locked = bool(snapshot.locks or snapshot.parent_locks)
+            if not locked:
                 to_remove.append(snapshot)
+            decisions.append((snapshot, locked))
 
-        logging.info("Removing {} snapshot(s) from "
-                     "{}:".format(len(to_remove), self))
-        for snapshot in snapshots:
-            if snapshot in to_remove:
-                logging.info("  {}".format(snapshot))
+        logging.info("Removing %s snapshot(s) from %s:", len(to_remove), self)
+        for snapshot, locked in decisions:
+            if locked:
+                logging.info("  %s - is locked, keeping it", snapshot)
             else:
-                logging.info("  {} - is locked, keeping it".format(snapshot))
+                logging.info("  %s", snapshot)
 
         if to_remove:
             # finally delete them
-            cmds = self._build_deletion_cmds(to_remove, **kwargs)
-            cmds = self._collapse_cmds(cmds, abort_on_failure=True)
-            for cmd in cmds:
-                self._exec_cmd(cmd)
+            self._delete_snapshots(to_remove, **kwargs)
 
             if self.__cached_snapshots is not None:
-                for snapshot in to_remove:
-                    try:
-                        self.__cached_snapshots.remove(snapshot)
-                    except ValueError:
-                        pass
+                removed = set(to_remove)
+                self.__cached_snapshots = [s for s in self.__cached_snapshots
+                                           if s not in removed]
+                self.__snapshots_view = None
 
     def delete_snapshot(self, snapshot, **kwargs):
         self.delete_snapshots([snapshot], **kwargs)
@@ -259,6 +290,16 @@ class Endpoint:
            The stream is piped into stdin when the command is running."""
         return ["btrfs", "receive"] + self.btrfs_flags + [dest]
 
+    def _delete_snapshots(self, snapshots, **kwargs):
+        """Deletes the given ``snapshots`` unconditionally. The default
+           implementation executes the commands ``_build_deletion_cmds``
+           returns for them, passing all keyword arguments to it."""
+        cmds = self._build_deletion_cmds(snapshots, **kwargs)
+        cmds = self._collapse_cmds(cmds, abort_on_failure=True)
+        for cmd in cmds:
+            self._exec_cmd(cmd, method="check_call",
+                           stdout=subprocess.DEVNULL)
+
     def _build_deletion_cmds(self, snapshots, convert_rw=None,
                              subvolume_sync=None):
         """Should return a list of commands that, when executed in order,
@@ -271,14 +312,15 @@ class Endpoint:
             subvolume_sync = self.subvolume_sync
 
         cmds = []
+        paths = [snapshot.get_path() for snapshot in snapshots]
 
         if convert_rw:
-            for snapshot in snapshots:
-                cmds.append(["btrfs", "property", "set", "-ts",
-                             snapshot.get_path(), "ro", "false"])
+            for path in paths:
+                cmds.append(["btrfs", "property", "set", "-ts", path, "ro",
+                             "false"])
 
         cmd = ["btrfs", "subvolume", "delete"]
-        cmd.extend([snapshot.get_path() for snapshot in snapshots])
+        cmd.extend(paths)
         cmds.append(cmd)
 
         if subvolume_sync:
@@ -305,8 +347,9 @@ class Endpoint:
            for instance."""
         return util.exec_subprocess(cmd, **kwargs)
 
-    def _listdir(self, location):
-        """Should return all items present at the given ``location``."""
+    def _listdir(self, location, prefix=""):
+        """Should return all items present at the given ``location``.
+           Items not starting with ``prefix`` may be left out."""
         return os.listdir(location)
 
     @require_source
@@ -321,13 +364,23 @@ class Endpoint:
            ``util.read_locks`` returns it."""
         path = self._get_lock_file_path()
         try:
-            if not os.path.isfile(path):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                return {}
+            if not stat.S_ISREG(st.st_mode):
                 return {}
+            # don't parse the file again if it hasn't changed
+            state = (st.st_ino, st.st_size, st.st_mtime_ns)
+            if self.__cached_locks is not None and \
+               self.__cached_locks[0] == state:
+                return self.__cached_locks[1]
             with open(path, "r") as f:
-                return util.read_locks(f.read())
+                lock_dict = util.read_locks(f.read())
+            self.__cached_locks = (state, lock_dict)
+            return lock_dict
         except (OSError, ValueError) as e:
-            logging.error("Error on reading lock file {}: "
-                          "{}".format(path, e))
+            logging.error("Error on reading lock file %s: %s", path, e)
             raise util.AbortError()
 
     @require_source
@@ -336,10 +389,31 @@ class Endpoint:
            ``util.read_locks`` returns it."""
         path = self._get_lock_file_path()
         try:
-            logging.debug("Writing lock file: {}".format(path))
-            with open(path, "w") as f:
+            # don't write the file again if its content wouldn't change
+            if self.__cached_locks is not None and \
+               self.__cached_locks[1] == lock_dict:
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    pass
+                else:
+                    if (st.st_ino, st.st_size, st.st_mtime_ns) == \
+                       self.__cached_locks[0]:
+                        logging.debug("Lock file is up to date: %s", path)
+                        return
+            logging.debug("Writing lock file: %s", path)
+            # The new content is written to a temporary file first, which
+            # then replaces the lock file. A crash thus can't leave a
+            # truncated lock file behind.
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as f:
                 f.write(util.write_locks(lock_dict))
+                f.flush()
+                os.fsync(f.fileno())
+                st = os.fstat(f.fileno())
+            os.replace(tmp_path, path)
+            self.__cached_locks = ((st.st_ino, st.st_size, st.st_mtime_ns),
+                                   lock_dict)
         except OSError as e:
-            logging.error("Error on writing lock file {}: "
-                          "{}".format(path, e))
+            logging.error("Error on writing lock file %s: %s", path, e)
             raise util.AbortError()
@@ -18,6 +18,16 @@ class LocalEndpoint(Endpoint):
         """Return an id string to identify this endpoint over multiple runs."""
         return self.path
 
+    def snapshot(self, readonly=True, sync=True):
+        """Like ``Endpoint.snapshot``, but syncs via ``os.sync`` instead
+           of running the 'sync' command."""
+        snapshot = super(LocalEndpoint, self).snapshot(readonly=readonly,
+                                                       sync=False)
+        if sync:
+            logging.debug("Syncing disks ...")
+            os.sync()
+        return snapshot
+
     def _prepare(self):
         # create directories, if needed
         dirs = []
@@ -26,20 +36,54 @@ class LocalEndpoint(Endpoint):
         dirs.append(self.path)
         for d in dirs:
             if not os.path.isdir(d):
-                logging.info("Creating directory: {}".format(d))
+                logging.info("Creating directory: %s", d)
                 try:
                     os.makedirs(d)
                 except OSError as e:
-                    logging.error("Error creating new location {}: "
-                                  "{}".format(d, e))
+                    logging.error("Error creating new location %s: %s", d, e)
                     raise util.AbortError()
 
         if self.source is not None and self.fs_checks and \
            not util.is_subvolume(self.source):
-            logging.error("{} does not seem to be a btrfs "
-                          "subvolume".format(self.source))
+            logging.error("%s does not seem to be a btrfs subvolume",
+                          self.source)
             raise util.AbortError()
         if self.fs_checks and not util.is_btrfs(self.path):
-            logging.error("{} does not seem to be on a btrfs "
-                          "filesystem".format(self.path))
+            logging.error("%s does not seem to be on a btrfs filesystem",
+                          self.path)
             raise util.AbortError()
+
+    def _delete_snapshots(self, snapshots, convert_rw=None, **kwargs):
+        """Like ``Endpoint._delete_snapshots``, but makes the snapshots
+           writable via ioctl instead of running 'btrfs property set'
+           for each of them. Should that fail for any snapshot, the
+           commands are used for all of them."""
+        if convert_rw is None:
+            convert_rw = self.convert_rw
+        if convert_rw:
+            convert_rw = False
+            for snapshot in snapshots:
+                path = snapshot.get_path()
+                try:
+                    util.set_subvolume_readonly(path, False)
+                except OSError as e:
+                    logging.debug("Couldn't make %s writable via ioctl: %s",
+                                  path, e)
+                    convert_rw = True
+                    break
+        super(LocalEndpoint, self)._delete_snapshots(
+            snapshots, convert_rw=convert_rw, **kwargs)
+
+    def _listdir(self, location, prefix=""):
+        """Returns the names of all directories at the given ``location``
+           starting with ``prefix``. Snapshots are always directories,
+           and ``os.scandir`` tells them apart without an extra ``stat``
+           call. The cheap name check comes first, since ``is_dir`` has
+           to stat on file systems not reporting the file type."""
+        if not hasattr(os, "scandir"):
+            # Python < 3.5
+            return super(LocalEndpoint, self)._listdir(location,
+                                                       prefix=prefix)
+        return [entry.name for entry in os.scandir(location)
+                if entry.name.startswith(prefix)
+                and entry.is_dir(follow_symlinks=False)]
@@ -1,6 +1,14 @@
+import re
+import shutil
+
 from .common import Endpoint
 
 
+# commands consisting of these characters only are plain words separated
+# by spaces, which the shell would neither expand nor interpret
+_PLAIN_CMD_MATCH = re.compile(r"[\w@%+:,./ -]+\Z", re.ASCII).match
+
+
 class ShellEndpoint(Endpoint):
     def __init__(self, cmd, **kwargs):
         super(ShellEndpoint, self).__init__(**kwargs)
@@ -15,4 +23,9 @@ class ShellEndpoint(Endpoint):
         return "shell://{}".format(self.cmd)
 
     def _build_receive_cmd(self, dest):
+        argv = self.cmd.split()
+        # Without a shell in between, one process less is started. Shell
+        # builtins and missing commands are still left to the shell.
+        if argv and _PLAIN_CMD_MATCH(self.cmd) and shutil.which(argv[0]):
+            return argv
         return ["sh", "-c", self.cmd]
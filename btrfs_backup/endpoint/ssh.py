@@ -1,13 +1,57 @@
+import atexit
 import copy
+import hashlib
 import logging
 import os
+import re
+import shlex
+import shutil
 import subprocess
 import tempfile
+import threading
 
 from .. import util
 from .common import Endpoint
 
 
+# directory holding the control sockets of all ssh master connections
+# of this process and the masters started, as control path -> ssh command
+# or None, if starting the master failed
+_control_dir = None
+_control_masters = {}
+# idle time after which a master exits by itself, e.g. if this process
+# got killed before stopping it
+_CONTROL_PERSIST = 300
+# endpoints may be prepared concurrently; the global lock only guards
+# the per control path locks, so different hosts connect in parallel
+_control_lock = threading.Lock()
+_control_path_locks = {}
+
+
+def _get_control_dir():
+    """Returns the directory for control sockets, creating it on first
+       use. It is removed together with all masters at exit."""
+    global _control_dir
+    if _control_dir is None:
+        _control_dir = tempfile.mkdtemp(prefix="btrfs-backup-ssh-")
+        logging.debug("Created control socket directory: %s", _control_dir)
+        atexit.register(_close_control_masters)
+    return _control_dir
+
+def _close_control_masters():
+    """Stops all ssh master connections and removes the control socket
+       directory."""
+    for control_path, cmd in _control_masters.items():
+        if cmd is None:
+            continue
+        cmd = cmd[:-1] + ["-O", "exit", cmd[-1]]
+        logging.debug("Executing: %s", cmd)
+        subprocess.call(cmd, stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL)
+    _control_masters.clear()
+    shutil.rmtree(_control_dir, ignore_errors=True)
+
+
 class SSHEndpoint(Endpoint):
     def __init__(self, hostname, port=None, username=None, ssh_opts=None,
                  ssh_sudo=False, **kwargs):
@@ -16,6 +60,26 @@ class SSHEndpoint(Endpoint):
         self.port = port
         self.username = username
         self.ssh_opts = ssh_opts or []
+        # Share one connection per host among all ssh invocations, unless
+        # the user configured multiplexing already. ControlMaster=no makes
+        # ssh connect directly when no master is running.
+        self.control_path = None
+        if not any(opt.lower().startswith("control")
+                   for opt in self.ssh_opts):
+            self.control_path = os.path.join(
+                _get_control_dir(),
+                hashlib.sha1(self._build_connect_string(with_port=True)
+                             .encode()).hexdigest())
+            self.ssh_opts = self.ssh_opts + [
+                "ControlPath={}".format(self.control_path),
+                "ControlMaster=no"]
+        # all commands at the remote host are run with this prefix
+        cmd = ["ssh"]
+        if self.port:
+            cmd += ["-p", str(self.port)]
+        for opt in self.ssh_opts:
+            cmd += ["-o", opt]
+        self.__ssh_cmd = tuple(cmd + [self._build_connect_string()])
         self.sshfs_opts = copy.deepcopy(self.ssh_opts)
         self.sshfs_opts += ["auto_unmount", "reconnect", "cache=no"]
         self.ssh_sudo = ssh_sudo
@@ -46,18 +110,26 @@ class SSHEndpoint(Endpoint):
             util.exec_subprocess(cmd, method="call", stdout=subprocess.DEVNULL,
                                  stderr=subprocess.DEVNULL)
         except FileNotFoundError as e:
-            logging.debug("  -> got exception: {}".format(e))
+            logging.debug("  -> got exception: %s", e)
             logging.info("ssh command is not available")
             raise util.AbortError()
         else:
             logging.debug("  -> ssh is available")
 
-        # sshfs is useful for listing directories and reading/writing locks
+        if self.control_path:
+            with _control_lock:
+                lock = _control_path_locks.setdefault(self.control_path,
+                                                      threading.Lock())
+            with lock:
+                if self.control_path not in _control_masters:
+                    self._start_control_master()
+
+        # sshfs is useful for creating directories and reading/writing locks
         tempdir = tempfile.mkdtemp()
-        logging.debug("Created tempdir: {}".format(tempdir))
+        logging.debug("Created tempdir: %s", tempdir)
         mountpoint = os.path.join(tempdir, "mnt")
         os.makedirs(mountpoint)
-        logging.debug("Created directory: {}".format(mountpoint))
+        logging.debug("Created directory: %s", mountpoint)
         logging.debug("Mounting sshfs ...")
 
         cmd = ["sshfs"]
@@ -70,7 +142,7 @@ class SSHEndpoint(Endpoint):
             util.exec_subprocess(cmd, method="check_call",
                                  stdout=subprocess.DEVNULL)
         except FileNotFoundError as e:
-            logging.debug("  -> got exception: {}".format(e))
+            logging.debug("  -> got exception: %s", e)
             if self.source:
                 # we need that for the locks
                 logging.info("  The sshfs command is not available but it is "
@@ -78,6 +150,7 @@ class SSHEndpoint(Endpoint):
                 raise util.AbortError()
         else:
             self.sshfs = mountpoint
+            util.invalidate_fs_cache()
             logging.debug("  -> sshfs is available")
 
         # create directories, if needed
@@ -88,54 +161,58 @@ class SSHEndpoint(Endpoint):
         if self.sshfs:
             for d in dirs:
                 if not os.path.isdir(self._path2sshfs(d)):
-                    logging.info("Creating directory: {}".format(d))
+                    logging.info("Creating directory: %s", d)
                     try:
                         os.makedirs(self._path2sshfs(d))
                     except OSError as e:
-                        logging.error("Error creating new location {}: "
-                                      "{}".format(d, e))
+                        logging.error("Error creating new location %s: %s",
+                                      d, e)
                         raise util.AbortError()
         else:
             cmd = ["mkdir", "-p"] + dirs
-            self._exec_cmd(cmd)
+            self._exec_cmd(cmd, method="check_call",
+                           stdout=subprocess.DEVNULL)
 
     def _collapse_cmds(self, cmds, abort_on_failure=True):
-        """Concatenates all given commands, ';' is inserted as separator."""
+        """Concatenates all given commands to a script run by a single
+           remote 'sh', '&&' or ';' is inserted as separator."""
 
-        collapsed = []
-        for i, cmd in enumerate(cmds):
-            if isinstance(cmd, (list, tuple)):
-                collapsed.extend(cmd)
-                if len(cmds) > i + 1:
-                    collapsed.append("&&" if abort_on_failure else ";")
-
-        return [collapsed]
+        sep = " && " if abort_on_failure else "; "
+        script = sep.join(" ".join(shlex.quote(arg) for arg in cmd)
+                          for cmd in cmds if isinstance(cmd, (list, tuple)))
+        return [["sh", "-c", script]]
 
     def _exec_cmd(self, orig_cmd, **kwargs):
-        """Executes the command at the remote host."""
+        """Executes the command at the remote host. The arguments are
+           quoted for the remote shell."""
 
-        cmd = ["ssh"]
-        if self.port:
-            cmd += ["-p", str(self.port)]
-        for opt in self.ssh_opts:
-            cmd += ["-o", opt]
-        cmd += [self._build_connect_string()]
+        cmd = list(self.__ssh_cmd)
         if self.ssh_sudo:
             cmd += ["sudo"]
-        cmd.extend(orig_cmd)
+        cmd.extend(shlex.quote(arg) for arg in orig_cmd)
 
         return util.exec_subprocess(cmd, **kwargs)
 
-    def _listdir(self, location):
-        """Operates remotely via 'ls -1A'."""
+    def _listdir(self, location, prefix=""):
+        """Operates remotely via 'find', which leaves out items not
+           starting with ``prefix`` already. This is a single round trip
+           over the master connection. sshfs is used instead, if mounted
+           and 'find' fails."""
 
-        if self.sshfs:
-            items = os.listdir(self._path2sshfs(location))
-        else:
-            cmd = ["ls", "-1A", location]
+        # escape glob characters of the prefix for -name
+        pattern = re.sub(r"([*?[\\])", r"\\\1", prefix) + "*"
+        # -H follows location itself, should it be a symlink
+        cmd = ["find", "-H", location, "-mindepth", "1", "-maxdepth", "1",
+               "-name", pattern, "-print0"]
+        try:
             output = self._exec_cmd(cmd, universal_newlines=True)
-            items = output.splitlines()
-        return items
+        except util.AbortError:
+            if not self.sshfs:
+                raise
+            logging.debug("  -> listing via sshfs instead")
+            return os.listdir(self._path2sshfs(location))
+        return [os.path.basename(path)
+                for path in output.split("\0") if path]
 
     def _get_lock_file_path(self):
         return self._path2sshfs(super(SSHEndpoint, self)._get_lock_file_path())
@@ -143,6 +220,34 @@ class SSHEndpoint(Endpoint):
 
     ########## Custom methods
 
+    def _start_control_master(self):
+        """Starts a master connection in background that subsequent ssh
+           invocations are multiplexed over. Failing to do so is not
+           fatal, they connect directly then. Either way, the outcome is
+           recorded in ``_control_masters``."""
+        cmd = ["ssh"]
+        if self.port:
+            cmd += ["-p", str(self.port)]
+        for opt in self.ssh_opts:
+            if opt != "ControlMaster=no":
+                cmd += ["-o", opt]
+        connect_string = self._build_connect_string()
+        logging.debug("Starting ssh master connection ...")
+        try:
+            # the master mustn't keep a log piped from stderr open
+            util.exec_subprocess(
+                cmd + ["-o", "ControlMaster=yes",
+                       "-o", "ControlPersist={}".format(_CONTROL_PERSIST),
+                       "-N", "-f", connect_string],
+                method="check_call", stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+        except util.AbortError:
+            logging.debug("  -> couldn't start master, connecting "
+                          "directly")
+            _control_masters[self.control_path] = None
+        else:
+            _control_masters[self.control_path] = cmd + [connect_string]
+
     def _build_connect_string(self, with_port=False):
         s = self.hostname
         if self.username:
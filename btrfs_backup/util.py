@@ -1,6 +1,11 @@
+import bisect
+import datetime
+import fcntl
 import functools
 import sys
 import os
+import re
+import struct
 import time
 import json
 import subprocess
@@ -9,7 +14,21 @@ import logging
 
 
 DATE_FORMAT = "%Y%m%d-%H%M%S"
+# matches the strings produced by date2str() with DATE_FORMAT
+DATE_REGEX = r"\d{8}-\d{6}"
+# splits such strings into their fields
+_DATE_FORMAT_MATCH = re.compile(r"(\d{4})(\d\d)(\d\d)-(\d\d)(\d\d)(\d\d)\Z",
+                                re.ASCII).match
 MOUNTS_FILE = "/proc/mounts"
+PIPE_MAX_SIZE_FILE = "/proc/sys/fs/pipe-max-size"
+# buffer size for pipes carrying send streams
+PIPE_SIZE = 1 << 20
+# not exposed by the fcntl module before Python 3.10
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+# _IOR/_IOW(BTRFS_IOCTL_MAGIC, 25/26, __u64) from linux/btrfs.h
+BTRFS_IOC_SUBVOL_GETFLAGS = 0x80089419
+BTRFS_IOC_SUBVOL_SETFLAGS = 0x4008941a
+BTRFS_SUBVOL_RDONLY = 1 << 1
 
 
 class AbortError(Exception):
@@ -21,7 +40,9 @@ class SnapshotTransferError(AbortError):
 
 @functools.total_ordering
 class Snapshot:
-    """Represents a snapshot with comparison by prefix and time_obj."""
+    """Represents a snapshot with comparison by prefix and time_obj.
+       These, as well as location, mustn't change after creation,
+       since the object is hashed and its name and path are cached."""
     def __init__(self, location, prefix, endpoint, time_obj=None):
         self.location = location
         self.prefix = prefix
@@ -31,10 +52,15 @@ class Snapshot:
         self.time_obj = time_obj
         self.locks = set()
         self.parent_locks = set()
+        self.__name = None
+        self.__path = None
 
     def __eq__(self, other):
         return self.prefix == other.prefix and self.time_obj == other.time_obj
 
+    def __hash__(self):
+        return hash((self.prefix, self.time_obj))
+
     def __lt__(self, other):
         if self.prefix != other.prefix:
             raise NotImplemented("prefixes dont match: "
@@ -45,21 +71,26 @@ class Snapshot:
         return self.get_name()
 
     def get_name(self):
-        return self.prefix + date2str(self.time_obj)
+        if self.__name is None:
+            self.__name = self.prefix + date2str(self.time_obj)
+        return self.__name
 
     def get_path(self):
-        return os.path.join(self.location, self.get_name())
+        if self.__path is None:
+            self.__path = os.path.join(self.location, self.get_name())
+        return self.__path
 
     def find_parent(self, present_snapshots):
         """Returns object from ``present_snapshot`` most suitable for being
            used as a parent for transferring this one or ``None``,
-           if none found."""
-        if self in present_snapshots:
+           if none found. ``present_snapshots`` has to be sorted."""
+        i = bisect.bisect_left(present_snapshots, self)
+        if i < len(present_snapshots) and present_snapshots[i] == self:
             # snapshot already transferred
             return None
-        for present_snapshot in reversed(present_snapshots):
-            if present_snapshot < self:
-                return present_snapshot
+        if i > 0:
+            # the newest snapshot older than this one
+            return present_snapshots[i - 1]
         # no snapshot older than snapshot is present ...
         if present_snapshots:
             # ... hence we choose the oldest one present as parent
@@ -70,15 +101,52 @@ def exec_subprocess(cmd, method="check_output", **kwargs):
     """Executes ``getattr(subprocess, method)(cmd, **kwargs)`` and takes
        care of proper logging and error handling. ``AbortError`` is raised
        in case of a ``subprocess.CalledProcessError``."""
-    logging.debug("Executing: {}".format(cmd))
+    logging.debug("Executing: %s", cmd)
     m = getattr(subprocess, method)
     try:
         return m(cmd, **kwargs)
     except subprocess.CalledProcessError:
-        logging.error("Error on command: {}".format(cmd))
+        logging.error("Error on command: %s", cmd)
         raise AbortError()
 
 
+def set_pipe_size(pipe, size=PIPE_SIZE):
+    """Tries to resize the buffer of ``pipe`` (a file object or
+       descriptor) to ``size`` bytes, but not more than the system allows.
+       Returns the new size or ``None``, if resizing failed."""
+    fd = pipe if isinstance(pipe, int) else pipe.fileno()
+    try:
+        with open(PIPE_MAX_SIZE_FILE) as f:
+            size = min(size, int(f.read()))
+    except (OSError, ValueError):
+        pass
+    try:
+        return fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError as e:
+        logging.debug("  Couldn't set pipe size to %s: %s", size, e)
+        return None
+
+
+def format_size(num_bytes):
+    """Returns ``num_bytes`` as human-readable string like '1.5MiB'."""
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if num_bytes < 1024 or unit == "TiB":
+            break
+        num_bytes /= 1024
+    return "{:.1f}{}".format(num_bytes, unit)
+
+
+def parse_size(s):
+    """Converts a size like '512M' to bytes. The suffixes k, M, G and T
+       are supported, as multiples of 1024. ``ValueError`` is raised
+       for invalid sizes."""
+    match = re.match(r"(\d+)([kKmMgGtT]?)\Z", s.strip())
+    if match is None:
+        raise ValueError("invalid size: {}".format(s))
+    exponent = " kmgt".index(match.group(2).lower() or " ")
+    return int(match.group(1)) * 1024 ** exponent
+
+
 def log_heading(caption):
     return "{:-<50}".format("--[ {} ]".format(caption))
 
@@ -97,22 +165,51 @@ def str2date(timestring=None, format=None):
         timestring = date2str()
     if format is None:
         format = DATE_FORMAT
+    return _strptime(timestring, format)
+
+@functools.lru_cache(maxsize=4096)
+def _strptime(timestring, format):
+    # the same snapshot names are parsed over and over again
+    match = _DATE_FORMAT_MATCH(timestring) if format == DATE_FORMAT else None
+    if match is not None:
+        # Building the result from the fields is much faster than the
+        # generic parser. Anything datetime rejects, e.g. leap seconds,
+        # is left to time.strptime.
+        try:
+            return datetime.datetime(*map(int, match.groups())).timetuple()
+        except ValueError:
+            pass
     return time.strptime(timestring, format)
 
 
+@functools.lru_cache(maxsize=1)
+def read_mounts():
+    """Returns a tuple of ``(mountpoint, fstype)`` tuples for all
+       file systems currently mounted. The result is cached until
+       ``invalidate_fs_cache`` is called."""
+    logging.debug("Reading mounts file: %s", MOUNTS_FILE)
+    mounts = []
+    with open(MOUNTS_FILE) as f:
+        for line in f:
+            try:
+                mountpoint, fstype = line.split(" ")[1:3]
+            except ValueError as e:
+                logging.debug("  Couldn't split line, skipping: %s", line)
+                continue
+            mounts.append((mountpoint, fstype))
+    return tuple(mounts)
+
+def invalidate_fs_cache():
+    """Should be called after mounting or unmounting file systems."""
+    read_mounts.cache_clear()
+
 def is_btrfs(path):
-    """Checks whether path is inside a btrfs file system"""
+    """Checks whether path is inside a btrfs file system."""
     path = os.path.normpath(os.path.abspath(path))
-    logging.debug("Checking for btrfs filesystem: {}".format(path))
+    logging.debug("Checking for btrfs filesystem: %s", path)
     best_match = ""
     best_match_fstype = ""
-    logging.debug("  Reading mounts file: {}".format(MOUNTS_FILE))
-    for line in open(MOUNTS_FILE):
-        try:
-            mountpoint, fstype = line.split(" ")[1:3]
-        except ValueError as e:
-            logging.debug("  Couldn't split line, skipping: {}".format(line))
-            continue
+    for mountpoint, fstype in read_mounts():
         mountpoint_prefix = mountpoint
         if not mountpoint_prefix.endswith(os.sep):
             mountpoint_prefix += os.sep
@@ -122,25 +219,43 @@ def is_btrfs(path):
         ):
             best_match = mountpoint
             best_match_fstype = fstype
-            logging.debug("  New best_match with fstype {}: "
-                          "{}".format(best_match_fstype, best_match))
+            logging.debug("  New best_match with fstype %s: %s",
+                          best_match_fstype, best_match)
     result = best_match_fstype == "btrfs"
-    logging.debug("  -> best_match_fstype is {}, result is "
-                  "{}".format(best_match_fstype, result))
+    logging.debug("  -> best_match_fstype is %s, result is %s",
+                  best_match_fstype, result)
     return result
 
 def is_subvolume(path):
     """Checks whether the given path is a btrfs subvolume."""
     if not is_btrfs(path):
         return False
-    logging.debug("Checking for btrfs subvolume: {}".format(path))
+    logging.debug("Checking for btrfs subvolume: %s", path)
     # subvolumes always have inode 256
     st = os.stat(path)
     result = st.st_ino == 256
-    logging.debug("  -> Inode is {}, result is {}".format(st.st_ino, result))
+    logging.debug("  -> Inode is %s, result is %s", st.st_ino, result)
     return result
 
 
+def set_subvolume_readonly(path, readonly):
+    """Sets or clears the read-only flag of the subvolume at ``path``
+       directly via ioctl, which is what 'btrfs property set' does
+       as well, but without starting a process.
+       ``OSError`` is raised on failure."""
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        buf = fcntl.ioctl(fd, BTRFS_IOC_SUBVOL_GETFLAGS, bytes(8))
+        flags = struct.unpack("=Q", buf)[0]
+        if readonly:
+            flags |= BTRFS_SUBVOL_RDONLY
+        else:
+            flags &= ~BTRFS_SUBVOL_RDONLY
+        fcntl.ioctl(fd, BTRFS_IOC_SUBVOL_SETFLAGS, struct.pack("=Q", flags))
+    finally:
+        os.close(fd)
+
+
 def read_locks(s):
     """Reads locks from lock file content given as string.
        Returns ``{'snapname': {'locks': ['lock', ...], ...},
@@ -163,9 +278,9 @@ def read_locks(s):
                 for lock in locks:
                     assert isinstance(lock, str)
                 # eliminate multiple occurances of locks
-                snap_entry[lock_type] = list(set(locks))
+                snap_entry[lock_type] = sorted(set(locks))
     except (AssertionError, json.JSONDecodeError) as e:
-        logging.error("Lock file couldn't be parsed: {}".format(e))
+        logging.error("Lock file couldn't be parsed: %s", e)
         raise ValueError("invalid lock file format")
 
     return content